@@ -19,9 +19,18 @@ OFDM transmitter and receiver with energy dispersal, pilot tones and cyclic pref
 #	along with this program; if not, write to the Free Software
 #	Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
+import os
 import numpy as np
 import random
 import scipy.signal
+import scipy.fft
+
+# FFTW is used if available because its plans can be reused
+# for every symbol. Otherwise we fall back to scipy's FFT.
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
 
 class OFDM:
     """
@@ -32,12 +41,14 @@ class OFDM:
     with a Nyquist quadrature modulator. On the receiver side the start of the symbol is detected by
     first doing a coarse search with the cyclic prefix and then a precision alignment with the pilots.
     """
-    def __init__(self, nFreqSamples = 2048, pilotDistanceInSamples = 16, pilotAmplitude = 2, nData = 256, nCyclic = None):
+    def __init__(self, nFreqSamples = 2048, pilotDistanceInSamples = 16, pilotAmplitude = 2, nData = 256, nCyclic = None, nWorkers = -1):
         """
         nFreqSamples sets the number of frequency coefficients of the FFT. Pilot tones are injected
         every pilotDistanceInSamples-th frequency sample. The real valued pilot amplitude is pilotAmplitude.
         For transmission nData bytes are expected in an array. The length of the Cyclic prefix is the number
-        of the real valued transmission samples.
+        of the real valued transmission samples. nWorkers is the number of threads for the FFTs.
+        Negative values count back from the number of CPU cores as in scipy.fft
+        so that -1 uses all cores and -2 all but one.
         """
         # the total number of frequency samples
         self.nIFFT = nFreqSamples
@@ -51,6 +62,14 @@ class OFDM:
             # the default cyclic prefix is a 1/4 of the length of the symbol
             self.nCyclic = int(self.nIFFT * 2 / 4)
 
+        # number of real valued samples of one transmitted symbol including its cyclic prefix
+        self.symbolLength = self.nCyclic + self.nIFFT * 2
+
+        # number of threads for the FFTs
+        if nWorkers == 0:
+            raise ValueError("nWorkers must not be zero")
+        self.nWorkers = nWorkers
+
         # distance between pilots	
         self.pilot_distance = pilotDistanceInSamples
 
@@ -61,6 +80,87 @@ class OFDM:
         # We assume that the spectrum is centred symmetrically around DC and depends on nData
         self.k_start = int(self.nIFFT - self.nIFFT / self.pilot_distance / 2 - nData * 4 / 2)
 
+        # Frequency indices of the data coefficients and the pilots
+        # so that the symbols can be scattered/gathered with index arrays.
+        # Starting at k_start, a pilot is inserted before every pilot_distance-th
+        # data coefficient beginning with the (pilot_distance/2)-th one, so every
+        # data coefficient is shifted up by the number of pilots before it.
+        # The indices wrap to positive frequencies.
+        c = np.arange(self.nData * 4)
+        pilot_before = (c + 1 - self.pilot_distance/2) % self.pilot_distance == 0
+        data_slots = c + np.cumsum(pilot_before)
+        self.data_k_indices = (self.k_start + data_slots) % self.nIFFT
+        self.pilot_k_indices = (self.k_start + data_slots[pilot_before] - 1) % self.nIFFT
+
+        # The four QPSK coefficients for every possible byte value:
+        # the even bits are real and the odd bits are imaginary with
+        # +1 for a set bit and -1 otherwise.
+        bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:,None], axis=1, bitorder='little') * 2.0 - 1
+        self.qpsk_table = bits[:,0::2] + 1j * bits[:,1::2]
+
+        # The spectrum of the transmitter with all complex frequency values set to zero.
+        # Only the data and pilot coefficients are overwritten by every symbol
+        # so that the buffer can be reused.
+        self.spectrum = np.zeros(self.nIFFT,dtype=complex)
+
+        # The pseudo random sequences of the energy dispersal for every random seed used
+        self.dispersal_sequences = {}
+
+        # Alternating signs +1,-1,+1,... of the Nyquist quadrature modulator
+        self.signs = np.ones(self.nIFFT)
+        self.signs[1::2] = -1
+
+        # FFTW plans for the inverse FFT of the encoder and the FFT of the decoder.
+        # They operate on the same aligned buffers and are planned once here.
+        if pyfftw:
+            if self.nWorkers > 0:
+                self.fftw_threads = self.nWorkers
+            else:
+                self.fftw_threads = os.cpu_count() + 1 + self.nWorkers
+                if self.fftw_threads < 1:
+                    raise ValueError("nWorkers value out of range; got {}, must not be less than {}".format(
+                        self.nWorkers, -os.cpu_count()))
+            self.fft_in = pyfftw.empty_aligned(self.nIFFT, dtype='complex128')
+            self.fft_out = pyfftw.empty_aligned(self.nIFFT, dtype='complex128')
+            self.ifft_plan = pyfftw.FFTW(self.fft_in, self.fft_out, direction='FFTW_BACKWARD',
+                                         flags=('FFTW_MEASURE',), threads=self.fftw_threads)
+            self.fft_plan = pyfftw.FFTW(self.fft_in, self.fft_out, direction='FFTW_FORWARD',
+                                        flags=('FFTW_MEASURE',), threads=self.fftw_threads)
+
+    def ifft(self,spectrum):
+        """
+        Inverse FFT of one symbol. With FFTW the result is
+        an internal buffer which is overwritten by the next transform.
+        """
+        if not pyfftw:
+            return scipy.fft.ifft(spectrum,workers=self.nWorkers)
+        self.fft_in[:] = spectrum
+        return self.ifft_plan()
+
+    def fft(self,symbol):
+        """
+        FFT of one symbol. With FFTW the result is
+        an internal buffer which is overwritten by the next transform.
+        """
+        if not pyfftw:
+            return scipy.fft.fft(symbol,workers=self.nWorkers)
+        self.fft_in[:] = symbol
+        return self.fft_plan()
+
+    def energyDispersal(self,randomSeed = 1):
+        """
+        Returns the nData pseudo random bytes for the energy dispersal.
+        The random number generator is set to a known start value
+        so that it always generates the same sequence from this start value.
+        The sequence is only generated once per random seed and then cached.
+        """
+        if randomSeed not in self.dispersal_sequences:
+            rng = random.Random(randomSeed)
+            r = np.fromiter((rng.randint(0,255) for x in range(self.nData)), dtype=np.uint8, count=self.nData)
+            r.setflags(write=False)
+            self.dispersal_sequences[randomSeed] = r
+        return self.dispersal_sequences[randomSeed]
+
     def encode(self,signal,data,randomSeed = 1):
         """
         Creates an OFDM symbol as QAM = 2 bits per frequency sample. 
@@ -69,70 +169,40 @@ class OFDM:
         The random seed sets the pseudo random number generator for the
         engergy dispersal.
         """
-        # create an empty spectrum with all complex frequency values set to zero
-        self.spectrum = np.zeros(self.nIFFT,dtype=complex)
+        # Append the cyclic prefix and the real valued symbol to the signal
+        # in one go by writing them into a buffer of the final length
+        n = len(signal)
+        out = np.empty(n + self.symbolLength)
+        out[:n] = signal
+        self.encodeInto(out,n,data,randomSeed)
+        return out
+
+    def encodeInto(self,out,start,data,randomSeed = 1):
+        """
+        Creates an OFDM symbol like encode but writes the cyclic prefix and
+        the symbol into the preallocated contiguous real valued array out at the index start.
+        Returns the index after the symbol where the next one can be written.
+        """
+        # We xor the grey values from the image with a pseudo random
+        # sequence which is called "engery dispersal".
+        r = self.energyDispersal(randomSeed)
+
+        # Energy dispersal: xor the bytes with the random numbers
+        databytes = np.asarray(data[:self.nData]).astype(np.uint8) ^ r
 
-        # we start with a negative frequency and then
-        # work ourselves up to positive ones
-        k = self.k_start
-        
-        # set the random number generator to a known start value
-        # will generate always the same sequence from this start value
-        # We xor its value with the grey values from the image to
-        # generate a pseudo random sequence which is called "engery dispersal".
-        random.seed(randomSeed)
-        
-        # counter for the pilots
-        pilot_counter = self.pilot_distance/2
-        
-        # we loop through the data
-        for x in range(self.nData):
-
-            # get one byte
-            databyte = int(data[x])
-
-            # Energy dispersal
-            # Generate the random number
-            r = int(random.randint(0,255))
-            # xor the grey value with the random number
-            databyte = int(databyte ^ r)
-
-            # Create the bitstream from the byte
-            bitstream = np.zeros(8)
-            for bit in range(8):
-                m = 1 << bit
-                testbit = m & databyte
-                if testbit > 0:
-                    bitstream[bit] = 1
-                else:
-                    bitstream[bit] = -1
-
-            # now we have 8 bits which we distribute over four frequency samples
-            # with 4-QAM / QPSK coding
-            for cnum in range(4):
-                # Let's check if we need to insert a pilot
-                pilot_counter = pilot_counter - 1
-                if pilot_counter == 0:
-                    pilot_counter = self.pilot_distance
-                    self.spectrum[k] = self.pilot_amplitude
-                    k = k + 1
-                    if not (k < self.nIFFT):
-                        k = 0
-                self.spectrum[k] = complex(bitstream[int(cnum*2)],
-                                           bitstream[int(cnum*2+1)])
-                # increase the frequency index
-                k = k + 1
-                # wrap to positive frequencies once we have reached the last index
-                if not (k < self.nIFFT):
-                    k = 0
+        # now we have 8 bits per byte which we distribute over four frequency samples
+        # with 4-QAM / QPSK coding looked up in the table
+        self.spectrum[self.data_k_indices] = self.qpsk_table[databytes].ravel()
+        self.spectrum[self.pilot_k_indices] = self.pilot_amplitude
 
         # Create one symbol by transforming our frequency samples into
         # complex timedomain samples
-        complex_symbol = np.fft.ifft(self.spectrum)
+        complex_symbol = self.ifft(self.spectrum)
 
-        # Create an empty real valued symbol with twice the samples
-        # because we need to interleave real and complex values
-        tx_symbol = np.zeros(len(complex_symbol)*2)
+        # The real valued symbol is written directly into the output after
+        # the space for the cyclic prefix. It has twice the samples
+        # because we need to interleave real and complex values.
+        tx_symbol = out[start+self.nCyclic:start+self.symbolLength]
 
         # Now we upsample at factor 2 and interleave
         # the I and Q signals
@@ -141,26 +211,47 @@ class OFDM:
         # +Real(c(n)), +Imag(c(n)), -Real(c(n+1), -Imag(c(n+1))
         # and then repeat it until we have created our sequence
         # with twice the number of samples.
-        s = 1
-        txindex = 0
-        for smpl in complex_symbol:
-            tx_symbol[txindex] = s * np.real(smpl)
-            txindex = txindex + 1
-            tx_symbol[txindex] = s * np.imag(smpl)
-            txindex = txindex + 1
-            s = s * -1
+        # The complex samples are stored as real/imag pairs in memory so
+        # that the interleaving is a view and only the signs are applied.
+        np.multiply(complex_symbol.view(float).reshape(self.nIFFT,2), self.signs[:,None],
+                    out=tx_symbol.reshape(self.nIFFT,2))
 
         # Generate cyclic prefix taken from the end of the signal
         # This is now twice the length because we have two times
         # more samples, effectively transmitting at twice the
         # sampling rate
-        cyclicPrefix = tx_symbol[-self.nCyclic:]
+        out[start:start+self.nCyclic] = tx_symbol[-self.nCyclic:]
+        return start + self.symbolLength
 
-        # Add the cyclic prefix to the signal
-        signal = np.concatenate((signal,cyclicPrefix))
-        # Add the real valued symbol to the signal
-        signal = np.concatenate((signal,tx_symbol))
-        return signal
+    def encodeBatch(self,signal,data,randomSeed = 1):
+        """
+        Creates one OFDM symbol for every row of the 2D array data
+        which has nData bytes per row and appends them to the real valued
+        signal. This is the same as calling encode for every row but the
+        inverse Fourier Transforms of all symbols are done in one go.
+        """
+        databytes = np.asarray(data)[:,:self.nData].astype(np.uint8) ^ self.energyDispersal(randomSeed)
+        nSymbols = len(databytes)
+
+        # the spectra of all symbols
+        spectra = np.zeros((nSymbols,self.nIFFT),dtype=complex)
+        spectra[:,self.data_k_indices] = self.qpsk_table[databytes].reshape(nSymbols,self.nData*4)
+        spectra[:,self.pilot_k_indices] = self.pilot_amplitude
+        complex_symbols = scipy.fft.ifft(spectra,axis=1,workers=self.nWorkers)
+        if nSymbols > 0:
+            self.spectrum[:] = spectra[-1]
+
+        # Every symbol is the cyclic prefix followed by the real valued
+        # symbol from the Nyquist quadrature modulator. All of them are
+        # written directly into the output signal.
+        n = len(signal)
+        out = np.empty(n + nSymbols * self.symbolLength)
+        out[:n] = signal
+        symbols = out[n:].reshape(nSymbols,self.symbolLength)
+        np.multiply(complex_symbols.view(float).reshape(nSymbols,self.nIFFT,2), self.signs[:,None],
+                    out=symbols[:,self.nCyclic:].reshape(nSymbols,self.nIFFT,2))
+        symbols[:,:self.nCyclic] = symbols[:,-self.nCyclic:]
+        return out
 
 
     def initDecode(self,signal,offset):
@@ -183,81 +274,83 @@ class OFDM:
         # Skip cyclic prefix
         self.rxindex = self.rxindex + self.nCyclic
 
-        # The complex symbol in the time domain
-        rx_symbol = np.zeros(self.nIFFT,dtype=complex)
-        
         # Demodulate the signal with the Nyquist quadrature demodulator
-        for a in range(self.nIFFT):
-            realpart = self.s * self.signal[self.rxindex]
-            self.rxindex = self.rxindex + 1
-            imagpart = self.s * self.signal[self.rxindex]
-            self.rxindex = self.rxindex + 1
-            rx_symbol[a] = complex(realpart,imagpart)
-            self.s = self.s * -1
+        # which gives us the complex symbol in the time domain
+        rx = self.signal[self.rxindex:self.rxindex+self.nIFFT*2]
+        self.rxindex = self.rxindex + self.nIFFT*2
+        rx_symbol = self.s * self.signs * (rx[0::2] + 1j * rx[1::2])
+        # the sign flips once per complex sample
+        self.s = self.s * (-1)**self.nIFFT
 
         # Perform an FFT to get the frequency samples which code our signal as QPSK pairs
-        isymbol = np.fft.fft(rx_symbol)
-
-        # set the random number generator to the same value as in the transmitter so that
-        # we have exactly the same sequence
-        random.seed(randomSeed)
+        isymbol = self.fft(rx_symbol)
 
-        # we start at frequency index k_start
-        k = self.k_start
+        # the same random sequence as in the transmitter
+        r = self.energyDispersal(randomSeed)
 
-        # counter for the pilots
-        pilot_counter = self.pilot_distance/2
+        # sum of the imaginary parts of the pilot tones
+        # (only the imaginary parts are gathered from the spectrum)
+        imPilots = np.sum(np.abs(isymbol.imag[self.pilot_k_indices]))
+
+        # gather the four QPSK coefficients of every byte and create an array
+        # which contains the bits of one byte in every row:
+        # the first bit is in the real part of the coefficient and
+        # the second bit is in the imag part of the coefficient.
+        # The complex numbers are stored as real/imag pairs so that viewing
+        # them as floats gives us the bits already in the right order.
+        coeffs = isymbol[self.data_k_indices]
+        bitstreams = coeffs.view(float).reshape(self.nData,8) > 0
+
+        # now let's assemble the bits into proper bytes
+        databytes = np.packbits(bitstreams, axis=1, bitorder='little').ravel()
+
+        # de-scramble the bytes
+        data = (databytes ^ r).astype(float)
+        return data,imPilots
 
-        # the byte array storing the received data
-        data = np.zeros(self.nData)
 
-        # sum of the imaginary parts of the pilot tones
-        imPilots = 0
-
-        # we loop through one line in the image
-        for x in range(self.nData):
-
-            # decode one byte from 4 bytes in the FFT
-            # we first create an array which contains the bits in separate rows
-            bitstream = np.zeros(8)
-            # loop through four bytes in the fft 
-            for cnum in range(4):
-                # test for pilots and ignore
-                pilot_counter = pilot_counter - 1
-                if pilot_counter == 0:
-                    pilot_counter = self.pilot_distance
-                    imPilots = imPilots + np.abs(np.imag(isymbol[k]))
-                    k = k + 1
-                    if not (k < self.nIFFT):
-                        k = 0
-                # first bit is in the real part of the coefficient
-                bitstream[int(cnum*2)] = np.heaviside(np.real(isymbol[k]),0)
-                # second bit is in the imag part of the coefficient
-                bitstream[int(cnum*2+1)] = np.heaviside(np.imag(isymbol[k]),0)
-                # get the next FFT coefficient
-                k = k + 1
-                # we wrap to positive frequencies
-                if not (k < self.nIFFT):
-                    k = 0
-
-            # now let's assemble the bits into into a proper byte by
-            # using bit-wise or
-            databyte = 0
-
-            # let's loop through the bits
-            for bit in range(8):
-                mask = 1 << bit
-                if (bitstream[bit] > 0):
-                    databyte = int(mask | int(databyte))
-
-            # de-scramble the byte
-            r = int(random.randint(0,255))
-            databyte = databyte ^ r
-
-            # store it in the image
-            data[x] = databyte
+    def decodeBatch(self, nSymbols, randomSeed = 1):
+        """
+        Decodes nSymbols consecutive symbols like calling decode nSymbols
+        times but with one batched FFT. Returns a 2D array with
+        the data of one symbol in every row and an array with
+        the absolute values of the imaginary parts of the pilot tones
+        of every symbol.
+        """
+        # the received symbols without their cyclic prefix, one symbol per row
+        end = self.rxindex + nSymbols * self.symbolLength
+        symbols = self.signal[self.rxindex:end].reshape(nSymbols,self.symbolLength)[:,self.nCyclic:]
+        self.rxindex = end
+
+        # Nyquist quadrature demodulator where the sign
+        # continues from one symbol to the next
+        symbolSigns = self.s * (-1)**(self.nIFFT * np.arange(nSymbols))
+        self.s = self.s * (-1)**(self.nIFFT * nSymbols)
+        rx_symbols = symbolSigns[:,None] * self.signs * (symbols[:,0::2] + 1j * symbols[:,1::2])
+        isymbols = scipy.fft.fft(rx_symbols,axis=1,workers=self.nWorkers)
+
+        imPilots = np.sum(np.abs(isymbols.imag[:,self.pilot_k_indices]),axis=1)
+
+        # the bits of every byte are in the real/imag pairs of four coefficients
+        coeffs = isymbols.view(float).reshape(nSymbols,self.nIFFT,2)[:,self.data_k_indices]
+        bitstreams = coeffs.reshape(nSymbols,self.nData,8) > 0
+        databytes = np.packbits(bitstreams, axis=2, bitorder='little').reshape(nSymbols,self.nData)
+        data = (databytes ^ self.energyDispersal(randomSeed)).astype(float)
         return data,imPilots
 
+    def imagPilots(self, signal, offsets):
+        """
+        Returns for every symbol start index in the array offsets the sum of
+        the abs values of the imaginary parts of the pilot tones which is the
+        same as the second return value of decode after initDecode(signal,offset).
+        All symbols are demodulated and transformed with one batched FFT
+        and only the pilots are evaluated.
+        """
+        # the real valued symbols without their cyclic prefix, one per row
+        windows = signal[np.asarray(offsets)[:,None] + self.nCyclic + np.arange(self.nIFFT*2)]
+        rx_symbols = self.signs * (windows[:,0::2] + 1j * windows[:,1::2])
+        isymbols = scipy.fft.fft(rx_symbols,axis=1,workers=self.nWorkers)
+        return np.sum(np.abs(isymbols.imag[:,self.pilot_k_indices]),axis=1)
 
     def findSymbolStartIndex(self, signal, searchrangecoarse=None, searchrangefine = 25):
         """
@@ -274,22 +367,20 @@ class OFDM:
             searchrangecoarse = self.nIFFT*10
             
         # Let find the starting index with the cyclic prefix
-        crosscorr = np.array([])
-        for i in range(searchrangecoarse):
-            s1 = signal[i:i+self.nCyclic]
-            s2 = signal[i+self.nIFFT*2:i+self.nIFFT*2+self.nCyclic]
-            cc = np.correlate(s1,s2)
-            crosscorr = np.append(crosscorr,cc)
+        # The correlation at lag i is the sum of the products of the signal
+        # and the signal one symbol later over the length of the cyclic prefix.
+        # This is a moving sum which is calculated for all lags at once as
+        # the difference of the cumulative sum of the products.
+        n = searchrangecoarse + self.nCyclic - 1
+        products = signal[:n] * signal[self.nIFFT*2:self.nIFFT*2+n]
+        cumsum = np.concatenate(([0.0],np.cumsum(products)))
+        crosscorr = cumsum[self.nCyclic:] - cumsum[:-self.nCyclic]
 
         pks,_ = scipy.signal.find_peaks(crosscorr,distance=self.nIFFT*2)
         o1 = pks[0]
 
         # Now let's fine tune it by looking at the imaginary parts
-        imagpilots = np.array([])
-        for i in range(o1-searchrangefine,o1+searchrangefine):
-            self.initDecode(signal,i)
-            _,im = self.decode()
-            imagpilots = np.append(imagpilots,im)
+        imagpilots = self.imagPilots(signal,np.arange(o1-searchrangefine,o1+searchrangefine))
 
         # Correct it with the pilots
         o2 = o1 + np.argmin(imagpilots) - searchrangefine
@@ -28,8 +28,8 @@ import ofdm_codec
 ymax = 100
 xmax= 256
 
-# let's instantiate the OFDM codec
-ofdm = ofdm_codec.OFDM()
+# let's instantiate the OFDM codec with one line of the image per symbol
+ofdm = ofdm_codec.OFDM(nData = xmax)
 
 # OFDM reception as audio file
 fs,signal = wavfile.read('ofdm8000.wav')
@@ -58,13 +58,8 @@ plt.plot(np.arange(-searchRangeForPilotPeak,searchRangeForPilotPeak),sumofimag)
 
 ofdm.initDecode(signal,offset)
 
-# our image
-rx_image = np.empty((ymax,xmax))
-
-# loop for the y coordinate
-for y in range(ymax):
-    row,i = ofdm.decode()
-    rx_image[y,:] = row
+# our image where every line is one symbol
+rx_image,_ = ofdm.decodeBatch(ymax)
 
 plt.subplot(133)
 plt.title("Decoded image")
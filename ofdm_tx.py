@@ -38,11 +38,9 @@ offset = ofdm.nIFFT * 3
 # some dummy bytes before we start transmission
 signal = np.zeros(offset)
 
-# loop for the y coordinate, line by line
-for y in range(ymax):
-    # get a line from the image
-    row = a[y,:]
-    signal = ofdm.encode(signal,row)
+# every line of the image turns into one symbol
+# and all of them are encoded in one go
+signal = ofdm.encodeBatch(signal,a)
 
 # save it as a wav file to listen to
 wavfile.write('ofdm8000.wav',8000,signal)
@@ -60,16 +58,11 @@ plt.plot(np.linspace(0,1,len(signal)),np.abs(np.fft.fft(signal))/len(signal))
 #######################################################################
 # reception
 
-# our image
-rx_image = np.empty((ymax,xmax))
-
 # Let's do a sanity check. We cheat here as we know the index of the symbol start.
 ofdm.initDecode(signal,offset)
 
-# loop for the y coordinate
-for y in range(ymax):
-    row,i = ofdm.decode()
-    rx_image[y,:] = row
+# our image where every line is one symbol
+rx_image,_ = ofdm.decodeBatch(ymax)
 
 plt.subplot(133)
 plt.imshow(rx_image, cmap='gray')